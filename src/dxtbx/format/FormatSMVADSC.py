@@ -221,14 +221,19 @@ class FormatSMVADSC(FormatSMV):
             self._image_file, exposure_time, osc_start, osc_range, epoch
         )
 
+    # Lazily cached by get_raw_data - the image size cannot change between
+    # reads of the same file
+    _cached_image_size = None
+
     def get_raw_data(self):
         """Get the pixel intensities (i.e. read the image and return as a
         flex array of integers.)"""
 
-        assert len(self.get_detector()) == 1
-        panel = self.get_detector()[0]
-        image_size = panel.get_image_size()
-        return self._get_endianic_raw_data(size=image_size)
+        if self._cached_image_size is None:
+            detector = self.get_detector()
+            assert len(detector) == 1
+            self._cached_image_size = detector[0].get_image_size()
+        return self._get_endianic_raw_data(size=self._cached_image_size)
 
 
 if __name__ == "__main__":
@@ -1,7 +1,5 @@
 from __future__ import annotations
 
-import itertools
-
 import numpy as np
 import pytest
 
@@ -52,7 +50,15 @@ def test_basics():
     flumpy.Scuffer(i)
 
 
+# Dtype characters already covered by an earlier flex_numeric parametrization.
+# Several flex types alias the same C type on some platforms (e.g. int/int32,
+# and long/int64 on 64-bit POSIX); re-running the matrix for the aliases just
+# repeats identical buffer semantics.
+_tested_dtypes = set()
+
+
 @pytest.fixture(
+    scope="module",
     params=[
         "size_t",
         "uint8",
@@ -66,7 +72,7 @@ def test_basics():
         "int64",
         "float",
         "double",
-    ]
+    ],
 )
 def flex_numeric(request):
     flex_typename = request.param
@@ -75,56 +81,82 @@ def flex_numeric(request):
     # Don't do long on windows, we prefer to get int
     if flex_typename == "long" and np.dtype("l").itemsize == np.dtype("i").itemsize:
         pytest.skip("On this platform, flex.long = flex.int so latter preferred")
+    dtype_char = lookup_flex_type_to_numpy[flex_typename]
+    if dtype_char in _tested_dtypes:
+        pytest.skip(
+            f"flex.{flex_typename} aliases an already-tested numpy dtype "
+            f"({dtype_char})"
+        )
+    _tested_dtypes.add(dtype_char)
     return getattr(flex, flex_typename)
 
 
+@pytest.fixture(scope="module")
+def flex_numeric_dtype(flex_numeric):
+    """The numpy dtype character matching the flex_numeric parametrization"""
+    return lookup_flex_type_to_numpy[flex_numeric.__name__]
+
+
+# Canonical 1d test vector, built once per distinct dtype.  astype (rather
+# than a dtype= argument) is deliberate so that narrow integer types wrap
+# instead of raising.
+_canonical_1d = {
+    dtype: np.array([240, 259, 144, 187]).astype(dtype)
+    for dtype in set(lookup_flex_type_to_numpy.values())
+}
+
+
+@pytest.fixture(scope="module")
+def empty_grids():
+    """Shared grid objects - a flex.grid only describes a shape, so one
+    instance can serve every dtype parametrization"""
+    return {"2d": flex.grid(10, 10), "4d": flex.grid(1, 9, 8, 5)}
+
+
 def test_numeric_1d(flex_numeric):
     # 1d basics
     f1d = flex_numeric(range(10))
     as_np = flumpy.to_numpy(f1d)
-    assert (f1d == as_np).all()
+    assert np.array_equal(as_np, np.arange(10, dtype=as_np.dtype))
     # Change and make sure reflected in both
     as_np[2] = 42
-    assert (f1d == as_np).all()
+    assert as_np[2] == 42
+    assert f1d[2] == 42
     assert as_np.dtype.char != "?"
 
 
-def test_reverse_numeric_1d(flex_numeric):
-    dtype = lookup_flex_type_to_numpy[flex_numeric.__name__]
-    npo = np.array([240, 259, 144, 187]).astype(dtype)
+def test_reverse_numeric_1d(flex_numeric, flex_numeric_dtype):
+    # The tests mutate npo, so hand out a copy of the canonical vector
+    npo = _canonical_1d[flex_numeric_dtype].copy()
     fo = flumpy.from_numpy(npo)
     assert isinstance(fo, flex_numeric)
     assert fo.all() == npo.shape
-    assert all(fo[x] == npo[x] for x in range(4))
+    assert np.array_equal(flumpy.to_numpy(fo), npo)
     npo[0] = 42
-    assert all(fo[x] == npo[x] for x in range(4))
+    assert np.array_equal(flumpy.to_numpy(fo), npo)
     assert fo[0] == 42
 
 
-def test_numeric_2d(flex_numeric):
-    grid = flex.grid(10, 10)
-    fo = flex_numeric(grid)
+def test_numeric_2d(flex_numeric, empty_grids):
+    fo = flex_numeric(empty_grids["2d"])
     as_np = flumpy.to_numpy(fo)
 
-    for i in range(10):
-        for j in range(10):
-            as_np[j, i] = i + j
-            assert fo[j, i] == as_np[j, i]
-            fo[j, i] = max(i, j) - min(i, j)
-            assert fo[j, i] == as_np[j, i]
-
-
-def test_reverse_numeric_2d(flex_numeric):
-    dtype = lookup_flex_type_to_numpy[flex_numeric.__name__]
-    npo = np.array(
-        [[240, 259, 144, 187], [240, 259, 144, 187], [240, 259, 144, 187]]
-    ).astype(dtype)
+    ref = np.add.outer(np.arange(10), np.arange(10)).astype(as_np.dtype)
+    as_np[:] = ref
+    assert np.array_equal(as_np, ref)
+    # Write through the flex side and check the numpy view follows
+    fo[3, 4] = 42
+    assert as_np[3, 4] == 42
+
+
+def test_reverse_numeric_2d(flex_numeric, flex_numeric_dtype):
+    npo = np.tile(_canonical_1d[flex_numeric_dtype], (3, 1))
     fo = flumpy.from_numpy(npo)
     assert isinstance(fo, flex_numeric)
     assert fo.all() == npo.shape
-    assert all(fo[x] == npo[x] for x in itertools.product(range(3), range(4)))
+    assert np.array_equal(flumpy.to_numpy(fo), npo)
     npo[0] = 42
-    assert all(fo[x] == npo[x] for x in itertools.product(range(3), range(4)))
+    assert np.array_equal(flumpy.to_numpy(fo), npo)
     assert fo[0] == 42
     fo[0, 1] = 2
     assert npo[0, 1] == 2
@@ -135,44 +167,48 @@ def test_reverse_numeric_2d(flex_numeric):
     assert flumpy.from_numpy(npo_zero).size() == 0
 
 
-def test_numeric_4d(flex_numeric):
+def test_numeric_4d(flex_numeric, empty_grids):
     # Check that we can think fourth-dimensionally
-    grid = flex.grid(1, 9, 8, 5)
-    fo = flex_numeric(grid)
+    fo = flex_numeric(empty_grids["4d"])
     assert fo.nd() == 4
     as_np = flumpy.to_numpy(fo)
-    for indices in itertools.product(range(1), range(9), range(8), range(5)):
-        fo[indices] = sum(indices)
-        assert fo[indices] == as_np[indices]
+    ref = np.sum(np.indices((1, 9, 8, 5)), axis=0).astype(as_np.dtype)
+    as_np[:] = ref
+    assert np.array_equal(as_np, ref)
+    # Spot-check the flex side to keep the element-access path covered
+    assert fo[0, 0, 0, 0] == 0
+    assert fo[0, 8, 7, 4] == ref[0, 8, 7, 4]
 
 
-def test_reverse_numeric_4d(flex_numeric):
-    dtype = lookup_flex_type_to_numpy[flex_numeric.__name__]
-    npo = np.zeros((1, 9, 8, 5), dtype=dtype)
+def test_reverse_numeric_4d(flex_numeric, flex_numeric_dtype):
+    npo = np.zeros((1, 9, 8, 5), dtype=flex_numeric_dtype)
     fo = flumpy.from_numpy(npo)
     assert isinstance(fo, flex_numeric)
     assert fo.nd() == 4
-    for indices in itertools.product(range(1), range(9), range(8), range(5)):
-        fo[indices] = sum(indices)
-        assert fo[indices] == npo[indices]
+    expected = np.sum(np.indices((1, 9, 8, 5)), axis=0).astype(npo.dtype)
+    flumpy.to_numpy(fo)[:] = expected
+    assert np.array_equal(npo, expected)
+    # Keep the element binding paths covered
+    assert fo[0, 0, 0, 0] == 0
+    fo[0, 0, 0, 1] = 42
+    assert npo[0, 0, 0, 1] == 42
 
 
 def test_bool():
     fo = flex.bool(flex.grid([5, 5, 5, 5, 5]))
-    for indices in itertools.product(*([range(5)] * 5)):
-        fo[indices] = sum(indices) % 3 == 0 or sum(indices) % 5 == 0
     as_np = flumpy.to_numpy(fo)
-    for indices in itertools.product(*([range(5)] * 5)):
-        assert fo[indices] == as_np[indices]
-    assert fo.count(True) == as_np.sum()
+    sums = np.sum(np.indices((5,) * 5), axis=0)
+    expected = (sums % 3 == 0) | (sums % 5 == 0)
+    as_np[:] = expected
+    assert np.array_equal(as_np, expected)
+    assert fo.count(True) == int(expected.sum())
 
 
 def test_reverse_bool():
     sums = np.sum(np.indices((5, 5, 5, 5, 5)), axis=0)
     npo = np.logical_or(sums % 3 == 3, sums % 5 == 0)
     fo = flumpy.from_numpy(npo)
-    for idx in itertools.product(*[range(5)] * 5):
-        assert fo[idx] == npo[idx]
+    assert np.array_equal(flumpy.to_numpy(fo), npo)
     assert fo.count(True) == npo.sum()
 
 
@@ -180,14 +216,19 @@ def test_reverse_bool():
     "flex_vec", [flex.vec3_double, flex.vec3_int, cctbx_flex.miller_index]
 )
 def test_vec3(flex_vec):
-    basic_vector = [(i, i * 2, i * 3) for i in range(10)]
-    fo = flex_vec(basic_vector)
+    expected = np.stack(
+        [np.arange(10), 2 * np.arange(10), 3 * np.arange(10)], axis=1
+    ).astype(lookup_flex_type_to_numpy[flex_vec.__name__])
+    # Construct from a list of tuples to keep the sequence-conversion path covered
+    fo = flex_vec(list(map(tuple, expected.tolist())))
     as_np = flumpy.to_numpy(fo)
-    assert (as_np == fo).all()
+    np.testing.assert_array_equal(as_np, expected)
     as_np[0] = (0, 4, 0)
     as_np[1, 2] = 42
+    expected[0] = (0, 4, 0)
+    expected[1, 2] = 42
     assert fo[0] == (0, 4, 0)
-    assert (as_np == fo).all()
+    np.testing.assert_array_equal(as_np, expected)
 
 
 @pytest.mark.parametrize(
@@ -199,7 +240,7 @@ def test_reverse_vec3(flex_vec):
     fo = flumpy.vec_from_numpy(no)
     assert fo.all() == (5,)
     fo[0] = (1, 2, 3)
-    assert (no[0] == (1, 2, 3)).all()
+    np.testing.assert_array_equal(no[0], (1, 2, 3))
 
     with pytest.raises(ValueError):
         flumpy.vec_from_numpy(no.reshape((1, 15)))
@@ -239,11 +280,14 @@ def test_vec2(flex_vec):
     basic_vector = [(i, i * 2) for i in range(10)]
     fo = flex_vec(basic_vector)
     as_np = flumpy.to_numpy(fo)
-    assert (as_np == fo).all()
+    expected = np.array(basic_vector, dtype=as_np.dtype)
+    np.testing.assert_array_equal(as_np, expected)
     as_np[0] = (0, 4)
     as_np[1, 1] = 42
+    expected[0] = (0, 4)
+    expected[1, 1] = 42
     assert fo[0] == (0, 4)
-    assert (as_np == fo).all()
+    np.testing.assert_array_equal(as_np, expected)
 
 
 @pytest.mark.parametrize("flex_vec", [flex.vec2_double, flex.tiny_size_t_2])
@@ -259,9 +303,13 @@ def test_reverse_vec2(flex_vec):
 def test_mat3():
     fo = flex.mat3_double(10)
     as_np = flumpy.to_numpy(fo)
-    for i in range(10):
-        fo[i] = [1, i, 0, 0, 1, 0, i, 0, 1]
-    assert (as_np.reshape(10, 9) == fo).all()
+    data = np.tile(np.eye(3), (10, 1, 1))
+    data[:, 0, 1] = np.arange(10)
+    data[:, 2, 0] = np.arange(10)
+    as_np[:] = data.reshape(as_np.shape)
+    # Check the flex side sees the bulk write through the shared buffer
+    assert fo[4] == (1, 4, 0, 0, 1, 0, 4, 0, 1)
+    assert np.array_equal(as_np.reshape(10, 9), data.reshape(10, 9))
 
 
 def test_reverse_mat3():
@@ -272,7 +320,11 @@ def test_reverse_mat3():
     fo = flumpy.mat3_from_numpy(no)
     assert (no.reshape(10, 9) == fo).all()
 
-    flatter = np.copy(no.reshape(10, 9))
+    # Build the (10, 9) case directly rather than copying out of the
+    # (10, 3, 3) intermediate
+    flatter = np.tile(np.array([1, 0, 0, 0, 1, 0, 0, 0, 1], dtype=float), (10, 1))
+    flatter[:, 1] = np.arange(10)
+    flatter[:, 6] = np.arange(10)
     flatter[0][0] = 14
     assert no[0][0][0] != 14
     fo_2 = flumpy.mat3_from_numpy(flatter)